@@ -5,6 +5,10 @@ use graphrag_db::schema::EMBEDDING_DIMENSION;
 use reqwest::Client;
 use serde::{Deserialize, Serialize};
 use serde_json::{json, Value};
+use std::collections::hash_map::DefaultHasher;
+use std::collections::{HashMap, VecDeque};
+use std::hash::{Hash, Hasher};
+use std::sync::{Arc, Mutex, OnceLock};
 use std::time::Duration;
 use tracing::{debug, info};
 
@@ -15,6 +19,7 @@ const DEFAULT_TGI_URL: &str = "http://localhost:8082";
 const DEFAULT_TGI_PROVIDER: &str = "tgi";
 const DEFAULT_OLLAMA_MODEL: &str = "phi4-mini:latest";
 const DEFAULT_TEI_MAX_BATCH: usize = 32;
+const DEFAULT_TEI_CACHE_SIZE: usize = 4096;
 const DEFAULT_OLLAMA_TIMEOUT_SECS: u64 = 120;
 const DEFAULT_STRICT_ENTITY_JSON: bool = true;
 const DEFAULT_MAX_ENTITIES: usize = 30;
@@ -49,21 +54,37 @@ fn env_or_default(key: &str, default: &str) -> String {
     std::env::var(key).unwrap_or_else(|_| default.to_string())
 }
 
+/// Process-wide HTTP client so every inference client shares one connection pool.
+fn shared_http_client() -> Client {
+    static CLIENT: OnceLock<Client> = OnceLock::new();
+    CLIENT.get_or_init(Client::new).clone()
+}
+
+fn embedding_cache_size() -> usize {
+    std::env::var("TEI_CACHE_SIZE")
+        .ok()
+        .and_then(|value| value.parse::<usize>().ok())
+        .unwrap_or(DEFAULT_TEI_CACHE_SIZE)
+}
+
 #[derive(Clone)]
 pub struct TeiClient {
     client: Client,
     base_url: String,
     provider: TeiProvider,
     model: String,
+    /// Recently computed embeddings, shared by all clones of this client.
+    cache: Arc<Mutex<EmbeddingCache>>,
 }
 
 impl TeiClient {
     pub fn new(base_url: impl Into<String>) -> Self {
         Self {
-            client: Client::new(),
+            client: shared_http_client(),
             base_url: base_url.into(),
             provider: TeiProvider::Tei,
             model: DEFAULT_OLLAMA_EMBED_MODEL.to_string(),
+            cache: Arc::new(Mutex::new(EmbeddingCache::new(embedding_cache_size()))),
         }
     }
 
@@ -73,10 +94,11 @@ impl TeiClient {
             let url = env_or_default("TEI_URL", "http://localhost:11434");
             let model = env_or_default("TEI_MODEL", DEFAULT_OLLAMA_EMBED_MODEL);
             Self {
-                client: Client::new(),
+                client: shared_http_client(),
                 base_url: url,
                 provider: TeiProvider::Ollama,
                 model,
+                cache: Arc::new(Mutex::new(EmbeddingCache::new(embedding_cache_size()))),
             }
         } else {
             let url = env_or_default("TEI_URL", DEFAULT_TEI_URL);
@@ -85,6 +107,81 @@ impl TeiClient {
     }
 
     pub async fn embed(&self, text: &str, is_query: bool) -> Result<Vec<f32>> {
+        let key = embedding_cache_key(text, is_query);
+        if let Some(embedding) = self.cache_get(key) {
+            return Ok(embedding);
+        }
+
+        let embedding = self.embed_uncached(text, is_query).await?;
+        self.cache_insert(key, embedding.clone());
+        Ok(embedding)
+    }
+
+    pub async fn embed_batch(&self, texts: &[String], is_query: bool) -> Result<Vec<Vec<f32>>> {
+        if texts.is_empty() {
+            return Ok(Vec::new());
+        }
+
+        // Serve repeated inputs from the cache and embed each distinct miss once.
+        let keys: Vec<u64> = texts
+            .iter()
+            .map(|text| embedding_cache_key(text, is_query))
+            .collect();
+        let cached: Vec<Option<Vec<f32>>> = keys.iter().map(|key| self.cache_get(*key)).collect();
+
+        let mut miss_slots: HashMap<u64, usize> = HashMap::new();
+        let mut misses: Vec<&str> = Vec::new();
+        for ((text, key), hit) in texts.iter().zip(&keys).zip(&cached) {
+            if hit.is_none() {
+                miss_slots.entry(*key).or_insert_with(|| {
+                    misses.push(text.as_str());
+                    misses.len() - 1
+                });
+            }
+        }
+
+        let fresh = if misses.is_empty() {
+            Vec::new()
+        } else {
+            self.embed_batch_uncached(&misses, is_query).await?
+        };
+        for (key, slot) in &miss_slots {
+            self.cache_insert(*key, fresh[*slot].clone());
+        }
+
+        Ok(cached
+            .into_iter()
+            .zip(&keys)
+            .map(|(hit, key)| hit.unwrap_or_else(|| fresh[miss_slots[key]].clone()))
+            .collect())
+    }
+
+    /// Run a throwaway query and passage batch so the backend has its model
+    /// loaded and kernels warm before the first real request.
+    ///
+    /// Bypasses the cache, so nothing synthetic is kept around.
+    pub async fn warm_up(&self) -> Result<()> {
+        let start = std::time::Instant::now();
+        self.embed_uncached("warm up", true).await?;
+        self.embed_batch_uncached(&["warm up"; 8], false).await?;
+        info!(
+            "Embedding backend warmed up in {:.2}s",
+            start.elapsed().as_secs_f32()
+        );
+        Ok(())
+    }
+
+    fn cache_get(&self, key: u64) -> Option<Vec<f32>> {
+        self.cache.lock().ok().and_then(|mut cache| cache.get(key))
+    }
+
+    fn cache_insert(&self, key: u64, embedding: Vec<f32>) {
+        if let Ok(mut cache) = self.cache.lock() {
+            cache.insert(key, embedding);
+        }
+    }
+
+    async fn embed_uncached(&self, text: &str, is_query: bool) -> Result<Vec<f32>> {
         if matches!(self.provider, TeiProvider::Ollama) {
             let embedding = self.ollama_embed(text).await?;
             validate_embedding_dim(embedding.len())?;
@@ -111,66 +208,56 @@ impl TeiClient {
             .send()
             .await?
             .error_for_status()?
-            .json::<Value>()
+            .bytes()
             .await?;
 
-        let embedding = parse_embedding_response(response)?;
+        let embedding = decode_embeddings_body(&response)?
+            .into_iter()
+            .next()
+            .unwrap_or_default();
         validate_embedding_dim(embedding.len())?;
         Ok(embedding)
     }
 
-    pub async fn embed_batch(&self, texts: &[String], is_query: bool) -> Result<Vec<Vec<f32>>> {
-        if texts.is_empty() {
-            return Ok(Vec::new());
-        }
-
-        if matches!(self.provider, TeiProvider::Ollama) {
-            let mut results = Vec::with_capacity(texts.len());
-            for text in texts {
-                let embedding = self.ollama_embed(text).await?;
-                validate_embedding_dim(embedding.len())?;
-                results.push(embedding);
-            }
-            return Ok(results);
-        }
-
-        let prompt_name = if is_query {
-            std::env::var("TEI_PROMPT_NAME_QUERY").ok()
-        } else {
-            std::env::var("TEI_PROMPT_NAME_PASSAGE").ok()
-        };
-
+    async fn embed_batch_uncached(&self, texts: &[&str], is_query: bool) -> Result<Vec<Vec<f32>>> {
         let max_batch = std::env::var("TEI_MAX_BATCH")
             .ok()
             .and_then(|value| value.parse::<usize>().ok())
             .filter(|value| *value > 0)
             .unwrap_or(DEFAULT_TEI_MAX_BATCH);
 
-        let url = format!("{}/embed", self.base_url);
-        let mut results = Vec::with_capacity(texts.len());
+        let prompt_name = if is_query {
+            std::env::var("TEI_PROMPT_NAME_QUERY").ok()
+        } else {
+            std::env::var("TEI_PROMPT_NAME_PASSAGE").ok()
+        };
 
-        for chunk in texts.chunks(max_batch) {
-            let request = TeiEmbedBatchRequest {
-                inputs: chunk,
-                truncate: true,
-                prompt_name: prompt_name.as_deref(),
+        // Group similarly sized texts into the same request so the backend pads
+        // each batch to a shorter maximum length, then restore the caller's order.
+        let order = length_sorted_order(texts);
+        let sorted: Vec<&str> = order.iter().map(|&idx| texts[idx]).collect();
+        let mut results = vec![Vec::new(); texts.len()];
+        let mut position = 0usize;
+
+        for chunk in sorted.chunks(max_batch) {
+            let embeddings = match self.provider {
+                TeiProvider::Ollama => self.ollama_embed_batch(chunk).await?,
+                TeiProvider::Tei => self.tei_embed_batch(chunk, prompt_name.as_deref()).await?,
             };
 
-            let response = self
-                .client
-                .post(&url)
-                .json(&request)
-                .send()
-                .await?
-                .error_for_status()?
-                .json::<Value>()
-                .await?;
-
-            let embeddings = parse_embeddings_response(response)?;
-            if let Some(first) = embeddings.first() {
-                validate_embedding_dim(first.len())?;
+            if embeddings.len() != chunk.len() {
+                return Err(AgentError::Processing(format!(
+                    "Embeddings service returned {} embeddings for {} inputs",
+                    embeddings.len(),
+                    chunk.len()
+                )));
+            }
+
+            for embedding in embeddings {
+                validate_embedding_dim(embedding.len())?;
+                results[order[position]] = embedding;
+                position += 1;
             }
-            results.extend(embeddings);
         }
 
         Ok(results)
@@ -194,9 +281,13 @@ impl TeiClient {
 
     async fn ollama_embed(&self, text: &str) -> Result<Vec<f32>> {
         let url = format!("{}/api/embeddings", self.base_url);
+        // Runtime options such as num_thread let operators match the embedding
+        // runner to the host's cores without restarting Ollama.
+        let options = parse_ollama_options_env("TEI_OLLAMA_OPTIONS")?;
         let request = OllamaEmbedRequest {
-            model: self.model.clone(),
-            prompt: text.to_string(),
+            model: &self.model,
+            prompt: text,
+            options,
         };
 
         let response = self
@@ -211,6 +302,70 @@ impl TeiClient {
 
         Ok(response.embedding)
     }
+
+    async fn tei_embed_batch(
+        &self,
+        texts: &[&str],
+        prompt_name: Option<&str>,
+    ) -> Result<Vec<Vec<f32>>> {
+        let url = format!("{}/embed", self.base_url);
+        let request = TeiEmbedBatchRequest {
+            inputs: texts,
+            truncate: true,
+            prompt_name,
+        };
+
+        let response = self
+            .client
+            .post(&url)
+            .json(&request)
+            .send()
+            .await?
+            .error_for_status()?
+            .bytes()
+            .await?;
+
+        decode_embeddings_body(&response)
+    }
+
+    /// Embed a chunk of texts in one Ollama request so they share a forward pass.
+    async fn ollama_embed_batch(&self, texts: &[&str]) -> Result<Vec<Vec<f32>>> {
+        let url = format!("{}/api/embed", self.base_url);
+        let options = parse_ollama_options_env("TEI_OLLAMA_OPTIONS")?;
+        let request = OllamaEmbedBatchRequest {
+            model: &self.model,
+            input: texts,
+            options,
+        };
+
+        let response = self.client.post(&url).json(&request).send().await?;
+
+        // Older Ollama releases only expose the single-prompt /api/embeddings endpoint.
+        // Current releases also answer 404 for a missing model, with a JSON error body;
+        // surface that instead of retrying every text against the old endpoint.
+        if response.status() == reqwest::StatusCode::NOT_FOUND {
+            let body = response.text().await?;
+            if let Some(error) = ollama_error_message(&body) {
+                return Err(AgentError::InferenceService(format!(
+                    "Ollama embedding model {} unavailable: {}",
+                    self.model, error
+                )));
+            }
+            debug!("Ollama /api/embed unavailable; falling back to per-text embeddings");
+            let mut results = Vec::with_capacity(texts.len());
+            for text in texts {
+                results.push(self.ollama_embed(text).await?);
+            }
+            return Ok(results);
+        }
+
+        let response = response
+            .error_for_status()?
+            .json::<OllamaEmbedBatchResponse>()
+            .await?;
+
+        Ok(response.embeddings)
+    }
 }
 
 #[derive(Clone)]
@@ -218,6 +373,8 @@ pub struct TgiClient {
     client: Client,
     base_url: String,
     json_schema: Option<Value>,
+    /// Ollama `format` schema, built once from the configured caps.
+    extraction_schema: Value,
     provider: TgiProvider,
     model: String,
 }
@@ -225,9 +382,10 @@ pub struct TgiClient {
 impl TgiClient {
     pub fn new(base_url: impl Into<String>) -> Self {
         Self {
-            client: Client::new(),
+            client: shared_http_client(),
             base_url: base_url.into(),
             json_schema: None,
+            extraction_schema: entity_extraction_schema(),
             provider: TgiProvider::Tgi,
             model: DEFAULT_OLLAMA_MODEL.to_string(),
         }
@@ -239,9 +397,10 @@ impl TgiClient {
             let url = env_or_default("TGI_URL", "http://localhost:11434");
             let model = env_or_default("TGI_MODEL", DEFAULT_OLLAMA_MODEL);
             Self {
-                client: Client::new(),
+                client: shared_http_client(),
                 base_url: url,
                 json_schema: None,
+                extraction_schema: entity_extraction_schema(),
                 provider: TgiProvider::Ollama,
                 model,
             }
@@ -369,7 +528,7 @@ impl TgiClient {
                 max_new_tokens: Some(512),
                 return_full_text: Some(false),
                 stop: Some(vec!["\n\n".to_string()]),
-                grammar: self.json_schema.clone(),
+                grammar: self.json_schema.as_ref(),
             },
         };
 
@@ -392,6 +551,8 @@ impl TgiClient {
         options: Option<Value>,
     ) -> Result<(String, Option<String>)> {
         let url = format!("{}/api/chat", self.base_url);
+        // The timeout covers the whole request, including any time Ollama keeps it
+        // queued behind other generations.
         let timeout_secs = std::env::var("TGI_OLLAMA_TIMEOUT_SECS")
             .ok()
             .and_then(|value| value.parse::<u64>().ok())
@@ -399,19 +560,19 @@ impl TgiClient {
             .unwrap_or(DEFAULT_OLLAMA_TIMEOUT_SECS);
         let system_prompt = "You are a strict JSON generator. Output MUST be a single JSON object matching the provided schema. No prose, no markdown.";
         let request = OllamaChatRequest {
-            model: self.model.clone(),
-            messages: vec![
+            model: &self.model,
+            messages: [
                 OllamaChatMessage {
-                    role: "system".to_string(),
-                    content: system_prompt.to_string(),
+                    role: "system",
+                    content: system_prompt,
                 },
                 OllamaChatMessage {
-                    role: "user".to_string(),
-                    content: prompt.to_string(),
+                    role: "user",
+                    content: prompt,
                 },
             ],
             stream: false,
-            format: Some(entity_extraction_schema()),
+            format: Some(&self.extraction_schema),
             options,
         };
 
@@ -484,6 +645,79 @@ enum TeiProvider {
     Ollama,
 }
 
+fn embedding_cache_key(text: &str, is_query: bool) -> u64 {
+    let mut hasher = DefaultHasher::new();
+    is_query.hash(&mut hasher);
+    text.hash(&mut hasher);
+    hasher.finish()
+}
+
+/// Bounded least-recently-used map from input hashes to embeddings.
+///
+/// Recency is tracked with a queue of `(key, tick)` records; records made stale
+/// by a later access are skipped on eviction and compacted away periodically.
+struct EmbeddingCache {
+    capacity: usize,
+    tick: u64,
+    entries: HashMap<u64, (u64, Vec<f32>)>,
+    recency: VecDeque<(u64, u64)>,
+}
+
+impl EmbeddingCache {
+    fn new(capacity: usize) -> Self {
+        Self {
+            capacity,
+            tick: 0,
+            entries: HashMap::new(),
+            recency: VecDeque::new(),
+        }
+    }
+
+    fn get(&mut self, key: u64) -> Option<Vec<f32>> {
+        let tick = self.tick + 1;
+        let entry = self.entries.get_mut(&key)?;
+        entry.0 = tick;
+        let embedding = entry.1.clone();
+        self.touch(key, tick);
+        Some(embedding)
+    }
+
+    fn insert(&mut self, key: u64, embedding: Vec<f32>) {
+        if self.capacity == 0 {
+            return;
+        }
+
+        let tick = self.tick + 1;
+        self.entries.insert(key, (tick, embedding));
+        self.touch(key, tick);
+
+        while self.entries.len() > self.capacity {
+            let Some((key, tick)) = self.recency.pop_front() else {
+                break;
+            };
+            if self.is_current(key, tick) {
+                self.entries.remove(&key);
+            }
+        }
+    }
+
+    fn touch(&mut self, key: u64, tick: u64) {
+        self.tick = tick;
+        self.recency.push_back((key, tick));
+        if self.recency.len() > self.capacity.saturating_mul(4).max(64) {
+            let entries = &self.entries;
+            self.recency
+                .retain(|(key, tick)| entries.get(key).is_some_and(|(current, _)| current == tick));
+        }
+    }
+
+    fn is_current(&self, key: u64, tick: u64) -> bool {
+        self.entries
+            .get(&key)
+            .is_some_and(|(current, _)| *current == tick)
+    }
+}
+
 fn validate_embedding_dim(len: usize) -> Result<()> {
     if len != EMBEDDING_DIMENSION {
         return Err(AgentError::Processing(format!(
@@ -504,20 +738,20 @@ struct TeiEmbedRequest<'a> {
 
 #[derive(Serialize)]
 struct TeiEmbedBatchRequest<'a> {
-    inputs: &'a [String],
+    inputs: &'a [&'a str],
     truncate: bool,
     #[serde(skip_serializing_if = "Option::is_none")]
     prompt_name: Option<&'a str>,
 }
 
 #[derive(Serialize)]
-struct TgiGenerateRequest {
+struct TgiGenerateRequest<'a> {
     inputs: String,
-    parameters: TgiParameters,
+    parameters: TgiParameters<'a>,
 }
 
 #[derive(Serialize)]
-struct TgiParameters {
+struct TgiParameters<'a> {
     #[serde(skip_serializing_if = "Option::is_none")]
     max_new_tokens: Option<u32>,
     #[serde(skip_serializing_if = "Option::is_none")]
@@ -526,30 +760,40 @@ struct TgiParameters {
     stop: Option<Vec<String>>,
     // Best-effort: TGI may accept a grammar/JSON schema constraint.
     #[serde(skip_serializing_if = "Option::is_none")]
-    grammar: Option<Value>,
+    grammar: Option<&'a Value>,
 }
 
 #[derive(Serialize)]
-struct OllamaChatRequest {
-    model: String,
-    messages: Vec<OllamaChatMessage>,
+struct OllamaChatRequest<'a> {
+    model: &'a str,
+    messages: [OllamaChatMessage<'a>; 2],
     stream: bool,
     #[serde(skip_serializing_if = "Option::is_none")]
-    format: Option<Value>,
+    format: Option<&'a Value>,
     #[serde(skip_serializing_if = "Option::is_none")]
     options: Option<Value>,
 }
 
 #[derive(Serialize)]
-struct OllamaChatMessage {
-    role: String,
-    content: String,
+struct OllamaChatMessage<'a> {
+    role: &'a str,
+    content: &'a str,
 }
 
 #[derive(Serialize)]
-struct OllamaEmbedRequest {
-    model: String,
-    prompt: String,
+struct OllamaEmbedRequest<'a> {
+    model: &'a str,
+    prompt: &'a str,
+    #[serde(skip_serializing_if = "Option::is_none")]
+    options: Option<Value>,
+}
+
+#[derive(Serialize)]
+struct OllamaEmbedBatchRequest<'a> {
+    model: &'a str,
+    input: &'a [&'a str],
+    #[serde(skip_serializing_if = "Option::is_none")]
+    options: Option<Value>,
 }
 
 #[derive(Deserialize)]
@@ -573,31 +817,30 @@ struct OllamaEmbedResponse {
     embedding: Vec<f32>,
 }
 
-fn parse_embedding_response(value: Value) -> Result<Vec<f32>> {
-    match value {
-        Value::Array(items) => {
-            if items.is_empty() {
-                return Ok(Vec::new());
-            }
-            if items.first().map(|v| v.is_number()).unwrap_or(false) {
-                serde_json::from_value(Value::Array(items)).map_err(|e| {
-                    AgentError::Processing(format!("Invalid TEI embedding array: {}", e))
-                })
-            } else {
-                let first = items
-                    .into_iter()
-                    .next()
-                    .ok_or_else(|| AgentError::Processing("Missing embeddings".to_string()))?;
-                serde_json::from_value(first).map_err(|e| {
-                    AgentError::Processing(format!("Invalid TEI embedding array: {}", e))
-                })
-            }
-        }
-        other => Err(AgentError::Processing(format!(
-            "Unexpected TEI response format: {}",
-            other
-        ))),
+#[derive(Deserialize)]
+struct OllamaEmbedBatchResponse {
+    embeddings: Vec<Vec<f32>>,
+}
+
+/// Input indices ordered by text length (stable, so equal lengths keep their order).
+fn length_sorted_order(texts: &[&str]) -> Vec<usize> {
+    let mut order: Vec<usize> = (0..texts.len()).collect();
+    order.sort_by_key(|&idx| texts[idx].len());
+    order
+}
+
+/// Decode a TEI `/embed` body straight into vectors.
+///
+/// TEI answers with nested float arrays, which deserialize without building a
+/// `Value` tree; other layouts go through the shape-tolerant parser.
+fn decode_embeddings_body(body: &[u8]) -> Result<Vec<Vec<f32>>> {
+    if let Ok(embeddings) = serde_json::from_slice::<Vec<Vec<f32>>>(body) {
+        return Ok(embeddings);
     }
+
+    let value: Value = serde_json::from_slice(body)
+        .map_err(|e| AgentError::Processing(format!("Invalid TEI embeddings response: {}", e)))?;
+    parse_embeddings_response(value)
 }
 
 fn parse_embeddings_response(value: Value) -> Result<Vec<Vec<f32>>> {
@@ -626,21 +869,15 @@ fn parse_embeddings_response(value: Value) -> Result<Vec<Vec<f32>>> {
 }
 
 fn normalize_json_payload(payload: &str) -> String {
+    // Narrow the payload with borrowed slices and allocate only the final result.
     let trimmed = payload.trim();
-    if trimmed.is_empty() {
-        return trimmed.to_string();
-    }
 
     let without_fence = if trimmed.starts_with("```") {
-        let mut lines = trimmed.lines();
-        let _ = lines.next(); // drop ``` or ```json
-        let mut content = lines.collect::<Vec<_>>().join("\n");
-        if content.ends_with("```") {
-            content.truncate(content.len().saturating_sub(3));
-        }
-        content.trim().to_string()
+        // drop ``` or ```json
+        let body = trimmed.split_once('\n').map(|(_, rest)| rest).unwrap_or("");
+        body.strip_suffix("```").unwrap_or(body).trim()
     } else {
-        trimmed.to_string()
+        trimmed
     };
 
     if let (Some(start), Some(end)) = (without_fence.find('{'), without_fence.rfind('}')) {
@@ -649,11 +886,15 @@ fn normalize_json_payload(payload: &str) -> String {
         }
     }
 
-    without_fence
+    without_fence.to_string()
 }
 
 fn parse_ollama_options() -> Result<Option<Value>> {
-    let raw = match std::env::var("TGI_OLLAMA_OPTIONS") {
+    parse_ollama_options_env("TGI_OLLAMA_OPTIONS")
+}
+
+fn parse_ollama_options_env(key: &str) -> Result<Option<Value>> {
+    let raw = match std::env::var(key) {
         Ok(value) => value,
         Err(_) => return Ok(None),
     };
@@ -664,12 +905,13 @@ fn parse_ollama_options() -> Result<Option<Value>> {
     }
 
     let value: Value = serde_json::from_str(trimmed)
-        .map_err(|e| AgentError::Processing(format!("Invalid TGI_OLLAMA_OPTIONS JSON: {}", e)))?;
+        .map_err(|e| AgentError::Processing(format!("Invalid {} JSON: {}", key, e)))?;
 
     if !value.is_object() {
-        return Err(AgentError::Processing(
-            "TGI_OLLAMA_OPTIONS must be a JSON object".to_string(),
-        ));
+        return Err(AgentError::Processing(format!(
+            "{} must be a JSON object",
+            key
+        )));
     }
 
     Ok(Some(value))
@@ -725,6 +967,15 @@ fn ollama_predict_budgets(options: &Option<Value>) -> Vec<u32> {
     budgets
 }
 
+/// The `error` field of an Ollama JSON error body.
+///
+/// Routes Ollama does not serve return a plain-text 404 instead, so `None`
+/// means the endpoint itself is missing.
+fn ollama_error_message(body: &str) -> Option<String> {
+    let value: Value = serde_json::from_str(body).ok()?;
+    value.get("error")?.as_str().map(str::to_string)
+}
+
 fn should_retry_ollama_parse_failure(done_reason: Option<&str>) -> bool {
     !matches!(done_reason, Some("stop"))
 }
@@ -794,7 +1045,7 @@ fn parse_entity_extraction(payload: &str) -> Result<EntityExtraction> {
                         })?
                     }
                 };
-                let entities = parse_entities_value(&entities_value);
+                let entities = parse_entities_value(entities_value);
                 debug!("Recovered entities from malformed JSON payload");
                 return Ok(EntityExtraction {
                     entities,
@@ -804,7 +1055,7 @@ fn parse_entity_extraction(payload: &str) -> Result<EntityExtraction> {
             if let Some(entities_json) = extract_json_array(payload, "entities") {
                 let cleaned = clean_json_array(&entities_json);
                 if let Ok(entities_value) = serde_json::from_str::<Value>(&cleaned) {
-                    let entities = parse_entities_value(&entities_value);
+                    let entities = parse_entities_value(entities_value);
                     debug!("Recovered entities from unquoted entities key");
                     return Ok(EntityExtraction {
                         entities,
@@ -819,59 +1070,22 @@ fn parse_entity_extraction(payload: &str) -> Result<EntityExtraction> {
         }
     };
 
-    let entities = value
-        .get("entities")
-        .map(parse_entities_value)
-        .unwrap_or_default();
-
-    let relationships = value
-        .get("relationships")
-        .and_then(|v| v.as_array())
-        .map(|items| {
-            items
-                .iter()
-                .filter_map(|item| {
-                    let source = item
-                        .get("source")
-                        .or_else(|| item.get("entity1"))
-                        .or_else(|| item.get("from"))
-                        .and_then(|v| match v {
-                            Value::String(s) => Some(s.to_string()),
-                            Value::Array(arr) => arr.first().and_then(value_to_string),
-                            Value::Object(obj) => obj.get("name").and_then(value_to_string),
-                            _ => None,
-                        });
-                    let target = item
-                        .get("target")
-                        .or_else(|| item.get("entity2"))
-                        .or_else(|| item.get("to"))
-                        .and_then(|v| match v {
-                            Value::String(s) => Some(s.to_string()),
-                            Value::Array(arr) => arr.first().and_then(value_to_string),
-                            Value::Object(obj) => obj.get("name").and_then(value_to_string),
-                            _ => None,
-                        });
-                    let relationship_type = item
-                        .get("relationship_type")
-                        .or_else(|| item.get("relation_type"))
-                        .or_else(|| item.get("type"))
-                        .and_then(|v| v.as_str())
-                        .map(|s| s.to_string());
-
-                    match (source, target, relationship_type) {
-                        (Some(source), Some(target), Some(relationship_type)) => {
-                            Some(ExtractedRelationship {
-                                source,
-                                target,
-                                relationship_type,
-                            })
-                        }
-                        _ => None,
-                    }
-                })
-                .collect::<Vec<_>>()
-        })
-        .unwrap_or_default();
+    // Take the arrays out of the parsed document so names and types are moved
+    // into the result rather than cloned from it.
+    let (entities_value, relationships_value) = match value {
+        Value::Object(mut obj) => (obj.remove("entities"), obj.remove("relationships")),
+        _ => (None, None),
+    };
+
+    let entities = entities_value.map(parse_entities_value).unwrap_or_default();
+
+    let relationships = match relationships_value {
+        Some(Value::Array(items)) => items
+            .into_iter()
+            .filter_map(parse_relationship_value)
+            .collect(),
+        _ => Vec::new(),
+    };
 
     Ok(EntityExtraction {
         entities,
@@ -929,43 +1143,47 @@ fn extract_json_array(payload: &str, key: &str) -> Option<String> {
 }
 
 fn clean_json_array(payload: &str) -> String {
-    payload
-        .replace(",]", "]")
-        .replace("\n", "")
-        .replace("\r", "")
+    // One pass that drops line breaks and trailing commas before `]`, instead of
+    // a separate scan and allocation per fix-up.
+    let mut cleaned = String::with_capacity(payload.len());
+    for ch in payload.chars() {
+        match ch {
+            '\n' | '\r' => {}
+            ']' => {
+                if cleaned.ends_with(',') {
+                    cleaned.pop();
+                }
+                cleaned.push(']');
+            }
+            _ => cleaned.push(ch),
+        }
+    }
+    cleaned
 }
 
-fn parse_entities_value(value: &Value) -> Vec<ExtractedEntity> {
+fn parse_entities_value(value: Value) -> Vec<ExtractedEntity> {
     let items = match value {
         Value::Array(items) => items,
-        other => {
-            if let Some(items) = other.get("entities").and_then(|v| v.as_array()) {
-                items
-            } else {
-                return Vec::new();
-            }
-        }
+        Value::Object(mut obj) => match obj.remove("entities") {
+            Some(Value::Array(items)) => items,
+            _ => return Vec::new(),
+        },
+        _ => return Vec::new(),
     };
 
     items
-        .iter()
+        .into_iter()
         .filter_map(|item| match item {
             Value::String(name) => Some(ExtractedEntity {
-                name: name.to_string(),
+                name,
                 entity_type: None,
             }),
-            Value::Object(obj) => {
-                let name = obj
-                    .get("name")
-                    .or_else(|| obj.get("entity"))
-                    .or_else(|| obj.get("value"))
-                    .and_then(value_to_string)?;
-                let entity_type = obj
-                    .get("type")
-                    .or_else(|| obj.get("entity_type"))
-                    .or_else(|| obj.get("label"))
-                    .or_else(|| obj.get("category"))
-                    .and_then(value_to_string);
+            Value::Object(mut obj) => {
+                let name = take_first(&mut obj, &["name", "entity", "value"])
+                    .and_then(value_into_string)?;
+                let entity_type =
+                    take_first(&mut obj, &["type", "entity_type", "label", "category"])
+                        .and_then(value_into_string);
                 Some(ExtractedEntity { name, entity_type })
             }
             _ => None,
@@ -973,17 +1191,51 @@ fn parse_entities_value(value: &Value) -> Vec<ExtractedEntity> {
         .collect()
 }
 
-fn value_to_string(value: &Value) -> Option<String> {
+fn parse_relationship_value(item: Value) -> Option<ExtractedRelationship> {
+    let Value::Object(mut obj) = item else {
+        return None;
+    };
+
+    let source = take_first(&mut obj, &["source", "entity1", "from"])
+        .and_then(relationship_endpoint_into_string);
+    let target = take_first(&mut obj, &["target", "entity2", "to"])
+        .and_then(relationship_endpoint_into_string);
+    let relationship_type = take_first(&mut obj, &["relationship_type", "relation_type", "type"])
+        .and_then(|v| match v {
+            Value::String(s) => Some(s),
+            _ => None,
+        });
+
+    Some(ExtractedRelationship {
+        source: source?,
+        target: target?,
+        relationship_type: relationship_type?,
+    })
+}
+
+/// Remove and return the value of the first key present in `obj`.
+fn take_first(obj: &mut serde_json::Map<String, Value>, keys: &[&str]) -> Option<Value> {
+    keys.iter().find_map(|key| obj.remove(*key))
+}
+
+fn relationship_endpoint_into_string(value: Value) -> Option<String> {
+    match value {
+        Value::String(s) => Some(s),
+        Value::Array(arr) => arr.into_iter().next().and_then(value_into_string),
+        Value::Object(mut obj) => obj.remove("name").and_then(value_into_string),
+        _ => None,
+    }
+}
+
+fn value_into_string(value: Value) -> Option<String> {
     match value {
-        Value::String(s) => Some(s.to_string()),
+        Value::String(s) => Some(s),
         Value::Number(n) => Some(n.to_string()),
         Value::Bool(b) => Some(b.to_string()),
-        Value::Array(arr) => arr.first().and_then(value_to_string),
-        Value::Object(obj) => obj
-            .get("name")
-            .or_else(|| obj.get("entity"))
-            .or_else(|| obj.get("value"))
-            .and_then(value_to_string),
+        Value::Array(arr) => arr.into_iter().next().and_then(value_into_string),
+        Value::Object(mut obj) => {
+            take_first(&mut obj, &["name", "entity", "value"]).and_then(value_into_string)
+        }
         _ => None,
     }
 }
@@ -1013,3 +1265,121 @@ fn extract_generated_text(value: Value) -> Result<String> {
         ))),
     }
 }
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn length_sorted_order_groups_by_length() {
+        let texts = vec![
+            "a much longer piece of text",
+            "short",
+            "mid-sized text",
+            "tiny!",
+        ];
+
+        assert_eq!(length_sorted_order(&texts), vec![1, 3, 2, 0]);
+    }
+
+    #[test]
+    fn decode_embeddings_body_accepts_nested_and_flat_arrays() {
+        assert_eq!(
+            decode_embeddings_body(b"[[0.5,1.0],[2,3]]").unwrap(),
+            vec![vec![0.5, 1.0], vec![2.0, 3.0]]
+        );
+        assert_eq!(
+            decode_embeddings_body(b"[0.25,0.75]").unwrap(),
+            vec![vec![0.25, 0.75]]
+        );
+        assert!(decode_embeddings_body(b"{\"error\":\"boom\"}").is_err());
+    }
+
+    #[test]
+    fn ollama_error_message_distinguishes_missing_models_from_missing_routes() {
+        assert_eq!(
+            ollama_error_message(r#"{"error":"model \"bge-m3\" not found, try pulling it first"}"#)
+                .as_deref(),
+            Some("model \"bge-m3\" not found, try pulling it first")
+        );
+        assert_eq!(ollama_error_message("404 page not found"), None);
+    }
+
+    #[test]
+    fn embedding_cache_evicts_least_recently_used() {
+        let mut cache = EmbeddingCache::new(2);
+        cache.insert(1, vec![1.0]);
+        cache.insert(2, vec![2.0]);
+        assert_eq!(cache.get(1), Some(vec![1.0]));
+
+        cache.insert(3, vec![3.0]);
+
+        assert_eq!(cache.get(2), None);
+        assert_eq!(cache.get(1), Some(vec![1.0]));
+        assert_eq!(cache.get(3), Some(vec![3.0]));
+    }
+
+    #[test]
+    fn embedding_cache_with_zero_capacity_stores_nothing() {
+        let mut cache = EmbeddingCache::new(0);
+        cache.insert(1, vec![1.0]);
+        assert_eq!(cache.get(1), None);
+    }
+
+    #[test]
+    fn embedding_cache_key_distinguishes_queries_from_passages() {
+        assert_ne!(
+            embedding_cache_key("same text", true),
+            embedding_cache_key("same text", false)
+        );
+    }
+
+    #[test]
+    fn parse_entity_extraction_accepts_alternate_shapes() {
+        let payload = r#"{
+            "entities": ["Rust", {"entity": "Ferris", "label": "person"}, {"type": "org"}],
+            "relationships": [
+                {"from": ["Ferris"], "to": {"name": "Rust"}, "relation_type": "uses"},
+                {"source": "Rust", "target": "Ferris"}
+            ]
+        }"#;
+
+        let extraction = parse_entity_extraction(payload).unwrap();
+
+        assert_eq!(extraction.entities.len(), 2);
+        assert_eq!(extraction.entities[0].name, "Rust");
+        assert_eq!(extraction.entities[0].entity_type, None);
+        assert_eq!(extraction.entities[1].name, "Ferris");
+        assert_eq!(
+            extraction.entities[1].entity_type.as_deref(),
+            Some("person")
+        );
+        assert_eq!(extraction.relationships.len(), 1);
+        assert_eq!(extraction.relationships[0].source, "Ferris");
+        assert_eq!(extraction.relationships[0].target, "Rust");
+        assert_eq!(extraction.relationships[0].relationship_type, "uses");
+    }
+
+    #[test]
+    fn normalize_json_payload_strips_fences_and_prose() {
+        assert_eq!(
+            normalize_json_payload("```json\n{\"entities\":[]}\n```\n"),
+            "{\"entities\":[]}"
+        );
+        assert_eq!(
+            normalize_json_payload("Here you go: {\"entities\":[]} done"),
+            "{\"entities\":[]}"
+        );
+        assert_eq!(normalize_json_payload("```"), "");
+        assert_eq!(normalize_json_payload("  no json  "), "no json");
+    }
+
+    #[test]
+    fn clean_json_array_strips_newlines_and_trailing_commas() {
+        assert_eq!(clean_json_array("[\"a\",\r\n\"b\",]"), "[\"a\",\"b\"]");
+        assert_eq!(
+            clean_json_array("[{\"name\":\"x\"},\n]"),
+            "[{\"name\":\"x\"}]"
+        );
+    }
+}
@@ -1,11 +1,13 @@
 //! Librarian Agent - Ingests content and creates notes
 
 use crate::{Result, TeiClient, TgiClient};
+use futures::stream::{self, StreamExt};
 use graphrag_core::{
     record_id_to_string, ChatConversation, ChatExport, ChatMessage, Entity, EntityType,
     MessageRole, Note, NoteType, Source, SourceType,
 };
 use graphrag_db::Repository;
+use std::borrow::Cow;
 use std::collections::HashSet;
 use std::time::{Duration, Instant};
 use tracing::{debug, info, instrument};
@@ -13,6 +15,7 @@ use tracing::{debug, info, instrument};
 const DEFAULT_PROGRESS_EVERY: usize = 10;
 const DEFAULT_PROGRESS_EVERY_SECS: u64 = 5;
 const DEFAULT_EXTRACT_MAX_CHARS: usize = 8000;
+const DEFAULT_EXTRACT_CONCURRENCY: usize = 1;
 
 fn skip_entity_extraction() -> bool {
     std::env::var("SKIP_ENTITY_EXTRACTION")
@@ -39,24 +42,56 @@ fn extract_max_chars() -> usize {
         .unwrap_or(DEFAULT_EXTRACT_MAX_CHARS)
 }
 
-fn truncate_for_extraction(text: &str) -> String {
-    let max_chars = extract_max_chars();
+/// Notes extracted in flight at once. Opt-in: Ollama serves one request at a
+/// time by default, and time spent in its queue counts against the request timeout.
+fn extract_concurrency() -> usize {
+    std::env::var("EXTRACT_CONCURRENCY")
+        .ok()
+        .and_then(|value| value.parse::<usize>().ok())
+        .filter(|value| *value > 0)
+        .unwrap_or(DEFAULT_EXTRACT_CONCURRENCY)
+}
+
+fn truncate_for_extraction(text: &str) -> Cow<'_, str> {
+    truncate_chars(text, extract_max_chars())
+}
+
+/// Keep the first `max_chars` characters, borrowing the input when it already fits.
+fn truncate_chars(text: &str, max_chars: usize) -> Cow<'_, str> {
     if max_chars == 0 {
-        return text.to_string();
+        return Cow::Borrowed(text);
     }
 
-    let mut iter = text.chars();
-    let mut collected = String::new();
-    for _ in 0..max_chars {
-        if let Some(ch) = iter.next() {
-            collected.push(ch);
-        } else {
-            return text.to_string();
-        }
+    match text.char_indices().nth(max_chars) {
+        Some((end, _)) => Cow::Owned(format!("{}\n\n[truncated]", &text[..end])),
+        None => Cow::Borrowed(text),
     }
+}
 
-    collected.push_str("\n\n[truncated]");
-    collected
+/// Extractor labels (matched case-insensitively) and the entity types they map to.
+const ENTITY_TYPE_LABELS: &[(&str, EntityType)] = &[
+    ("person", EntityType::Person),
+    ("per", EntityType::Person),
+    ("organization", EntityType::Organization),
+    ("org", EntityType::Organization),
+    ("location", EntityType::Location),
+    ("loc", EntityType::Location),
+    ("gpe", EntityType::Location),
+    ("date", EntityType::Date),
+    ("time", EntityType::Date),
+];
+
+/// Map an extractor's free-form type label to an `EntityType` in a single scan
+/// of the label table, without allocating a lowercased copy per entity.
+fn classify_entity_type(label: Option<&str>) -> EntityType {
+    label
+        .and_then(|label| {
+            ENTITY_TYPE_LABELS
+                .iter()
+                .find(|(known, _)| known.eq_ignore_ascii_case(label))
+        })
+        .map(|(_, entity_type)| entity_type.clone())
+        .unwrap_or(EntityType::Concept)
 }
 
 /// The Librarian agent handles content ingestion
@@ -281,24 +316,16 @@ impl LibrarianAgent {
         let entities = extraction.entities;
         let extracted_count = entities.len();
         let mut linked_count = 0usize;
+        let mut seen = HashSet::with_capacity(extracted_count);
 
         for extracted in entities {
-            // Map string type to EntityType
-            let entity_type = match extracted
-                .entity_type
-                .as_deref()
-                .unwrap_or("concept")
-                .to_lowercase()
-                .as_str()
-            {
-                "person" | "per" => EntityType::Person,
-                "organization" | "org" => EntityType::Organization,
-                "location" | "loc" | "gpe" => EntityType::Location,
-                "date" | "time" => EntityType::Date,
-                _ => EntityType::Concept,
-            };
-
+            let entity_type = classify_entity_type(extracted.entity_type.as_deref());
             let entity = Entity::new(&extracted.name, entity_type);
+            // Models often repeat a mention with different casing or spacing;
+            // those collapse to the same entity, so skip the extra round trips.
+            if !seen.insert(entity.canonical_name.clone()) {
+                continue;
+            }
             let entity = self.repo.upsert_entity(entity).await?;
 
             // Link note to entity
@@ -343,25 +370,33 @@ impl LibrarianAgent {
         let start = Instant::now();
         let mut last_progress = Instant::now();
 
-        for (index, note) in notes.into_iter().enumerate() {
-            let note_id = note
-                .id
-                .as_ref()
-                .map(record_id_to_string)
-                .unwrap_or_else(|| "<unknown>".to_string());
-            let note_len = note.content.len();
-            if log_each {
-                info!(
-                    "Entity extraction start: {}/{} note_id={} chars={}",
-                    index + 1,
-                    total,
-                    note_id,
-                    note_len
-                );
-            }
+        // Each note is a round trip to the extraction backend plus a few DB
+        // writes, so keep several in flight instead of waiting on them serially.
+        let mut results = stream::iter(notes.into_iter().enumerate())
+            .map(|(index, note)| async move {
+                let note_id = note
+                    .id
+                    .as_ref()
+                    .map(record_id_to_string)
+                    .unwrap_or_else(|| "<unknown>".to_string());
+                if log_each {
+                    info!(
+                        "Entity extraction start: {}/{} note_id={} chars={}",
+                        index + 1,
+                        total,
+                        note_id,
+                        note.content.len()
+                    );
+                }
 
-            let note_start = Instant::now();
-            match self.extract_and_link_entities_force(&note).await {
+                let note_start = Instant::now();
+                let result = self.extract_and_link_entities_force(&note).await;
+                (index, note_id, note_start.elapsed(), result)
+            })
+            .buffer_unordered(extract_concurrency());
+
+        while let Some((index, note_id, elapsed, result)) = results.next().await {
+            match result {
                 Ok(()) => {
                     processed += 1;
                     if log_each {
@@ -370,7 +405,7 @@ impl LibrarianAgent {
                             index + 1,
                             total,
                             note_id,
-                            note_start.elapsed().as_secs_f32()
+                            elapsed.as_secs_f32()
                         );
                     }
                 }
@@ -381,7 +416,7 @@ impl LibrarianAgent {
                             index + 1,
                             total,
                             note_id,
-                            note_start.elapsed().as_secs_f32(),
+                            elapsed.as_secs_f32(),
                             e
                         );
                     } else {
@@ -922,8 +957,10 @@ impl LibrarianAgent {
         };
 
         let mut message_record_ids = Vec::with_capacity(conversation.messages.len());
+        let mut message_embeddings = message_embeddings.into_iter();
         for (idx, message) in conversation.messages.iter().enumerate() {
-            let embedding = message_embeddings.get(idx).cloned();
+            // Move each vector into its record instead of cloning it out of the batch.
+            let embedding = message_embeddings.next();
             let message_id = self
                 .repo
                 .upsert_message(
@@ -1627,4 +1664,37 @@ pub struct ChatImportResult {
 mod tests {
     // Integration tests require local inference backends
     // See tests/integration_test.rs
+
+    use super::*;
+
+    #[test]
+    fn classifies_entity_type_labels() {
+        assert_eq!(classify_entity_type(Some("PERSON")), EntityType::Person);
+        assert_eq!(classify_entity_type(Some("Org")), EntityType::Organization);
+        assert_eq!(classify_entity_type(Some("gpe")), EntityType::Location);
+        assert_eq!(classify_entity_type(Some("Time")), EntityType::Date);
+        assert_eq!(
+            classify_entity_type(Some("technology")),
+            EntityType::Concept
+        );
+        assert_eq!(classify_entity_type(None), EntityType::Concept);
+    }
+
+    #[test]
+    fn extract_concurrency_is_opt_in() {
+        std::env::remove_var("EXTRACT_CONCURRENCY");
+        assert_eq!(extract_concurrency(), 1);
+        std::env::set_var("EXTRACT_CONCURRENCY", "0");
+        assert_eq!(extract_concurrency(), 1);
+        std::env::set_var("EXTRACT_CONCURRENCY", "3");
+        assert_eq!(extract_concurrency(), 3);
+        std::env::remove_var("EXTRACT_CONCURRENCY");
+    }
+
+    #[test]
+    fn truncates_on_char_boundaries() {
+        assert_eq!(truncate_chars("héllo wörld", 4), "héll\n\n[truncated]");
+        assert!(matches!(truncate_chars("héllo", 5), Cow::Borrowed("héllo")));
+        assert!(matches!(truncate_chars("héllo", 0), Cow::Borrowed("héllo")));
+    }
 }
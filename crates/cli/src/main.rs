@@ -13,9 +13,12 @@ use graphrag_db::{init_memory, init_persistent, Repository};
 use serde::Deserialize;
 use std::io::{self, BufRead, Write};
 use std::path::PathBuf;
-use tracing::info;
+use std::time::Duration;
+use tracing::{info, warn};
 use tracing_subscriber::{EnvFilter, FmtSubscriber};
 
+const WARM_UP_TIMEOUT_SECS: u64 = 15;
+
 fn default_db_path() -> PathBuf {
     let mut path = dirs::home_dir().expect("Could not find home directory");
     path.push(".graphrag");
@@ -530,7 +533,7 @@ async fn main() -> Result<()> {
             note_ids,
             force,
         } => {
-            cmd_extract_entities(repo, tgi, limit, all, note_ids, force).await?;
+            cmd_extract_entities(repo, tei, tgi, limit, all, note_ids, force).await?;
         }
         Commands::ShowEntities { note_id } => {
             cmd_show_entities(repo, note_id).await?;
@@ -867,6 +870,7 @@ async fn cmd_migrate_chats(
 
 async fn cmd_extract_entities(
     repo: Repository,
+    tei: TeiClient,
     tgi: TgiClient,
     limit: usize,
     all: bool,
@@ -879,7 +883,7 @@ async fn cmd_extract_entities(
     if force && !all && note_ids.is_empty() {
         anyhow::bail!("--force requires --all or at least one --note-id");
     }
-    let librarian = LibrarianAgent::new(repo, TeiClient::default_local(), tgi);
+    let librarian = LibrarianAgent::new(repo, tei, tgi);
     let processed = if !note_ids.is_empty() {
         librarian
             .extract_entities_for_note_ids(&note_ids, force)
@@ -1536,6 +1540,17 @@ async fn cmd_interactive(repo: Repository, tei: TeiClient, tgi: TgiClient) -> Re
     let search = SearchAgent::new(repo.clone(), tei.clone());
     let gardener = GardenerAgent::new(repo.clone());
 
+    // Pay the backend's cold-start cost before the first prompt, not on the first search,
+    // but never let a hung backend keep the prompt from appearing.
+    match tokio::time::timeout(Duration::from_secs(WARM_UP_TIMEOUT_SECS), tei.warm_up()).await {
+        Ok(Ok(())) => {}
+        Ok(Err(e)) => warn!("Embedding warm-up failed (non-fatal): {}", e),
+        Err(_) => warn!(
+            "Embedding warm-up timed out after {}s (non-fatal)",
+            WARM_UP_TIMEOUT_SECS
+        ),
+    }
+
     println!("GraphRAG Notes - Interactive Mode");
     println!("Commands: add, search, list, garden, stats, help, quit");
     println!();